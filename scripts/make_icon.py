@@ -1,4 +1,5 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import sys
 from pathlib import Path
 
@@ -7,11 +8,16 @@ from PIL import Image
 
 def make_icon(input_path: Path, output_path: Path, resolutions: list[int]):
     input_image = Image.open(input_path)
-    input_image.save(
-        output_path.open("wb"),
-        format="icns",
-        append_images=[input_image.resize((res, res)) for res in resolutions],
-    )
+    # Decode once up front, so the resizes can share the decoded image.
+    # Pillow releases the GIL while resizing, so they can run in parallel.
+    # (Installing pillow-simd in place of pillow makes them faster still.)
+    input_image.load()
+    with ThreadPoolExecutor() as executor:
+        resized = list(
+            executor.map(lambda res: input_image.resize((res, res)), resolutions)
+        )
+    with output_path.open("wb") as output_file:
+        input_image.save(output_file, format="icns", append_images=resized)
 
 
 def intlist(ss: str):
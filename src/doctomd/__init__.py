@@ -5,74 +5,115 @@ A small command-line utility for converting Google Docs documents to Markdown
 that's suitable for pasting into ContentStack.
 """
 
-from logging import debug, info, getLogger
+from logging import debug, info
 from pathlib import Path
 import re
 from subprocess import Popen, PIPE
-from typing import List
-from urllib.parse import urlparse, parse_qs
+from typing import BinaryIO, Iterable, List, Optional, Set, Tuple, Union
+from urllib.parse import unquote_plus
 
-from bs4 import BeautifulSoup, Tag
-from cssutils import CSSParser
+from bs4 import BeautifulSoup, NavigableString, SoupStrainer, Tag
+from bs4.element import PreformattedString
 import mdformat
 import pypandoc
 
+from .style_extract import extract_style_classes, is_code_font  # noqa: F401
+
+
+# SoupStrainer only filters top-level elements, so this keeps the stylesheet
+# (needed to identify code, bold & italic classes) and the document body, while
+# skipping the <head> boilerplate (meta, title, scripts) that's never used.
+GOOGLE_DOC_STRAINER = SoupStrainer(["style", "body"])
+
+_GOOGLE_URL_RE = re.compile(r"https://www\.google\.com/url")
+# The first "q" parameter in the query string is the link's real destination:
+_GOOGLE_URL_TARGET_RE = re.compile(r"[?&]q=([^&#]+)")
+_BACKTICK_RE = re.compile(r"`")
+_BACKTICK_PAIR_RE = re.compile(r"`([^`]*)`")
+_NL_WS_RE = re.compile(r"\n\s+")
+_BUILDING_BLOCK_END_RE = re.compile("^\uEC02")
+_PYTHON_CODE_RE = re.compile(r"\b(?:import|def)\s")
+
+# Tags that can hold a line of code, which may be turned into a <pre>:
+_BLOCK_PARENTS = frozenset(("p", "div", "td"))
+
+PANDOC_INPUT_FORMAT = "html-native_divs-native_spans-raw_html"
+PANDOC_OUTPUT_FORMAT = "gfm-raw_html+pipe_tables"
+
+
+def parse_google_doc_html(markup: Union[str, bytes]) -> BeautifulSoup:
+    """
+    Parse HTML exported from Google Docs, keeping only the parts that
+    process_google_doc_html needs.
+
+    `markup` can be the file's bytes, to avoid decoding it separately first.
+    Google Docs exports are UTF-8, so that's tried before any other encoding.
+    """
+    if isinstance(markup, bytes):
+        return BeautifulSoup(
+            markup, "lxml", parse_only=GOOGLE_DOC_STRAINER, from_encoding="utf-8"
+        )
+    return BeautifulSoup(markup, "lxml", parse_only=GOOGLE_DOC_STRAINER)
+
 
 def flatten_html_line(line: Tag) -> str:
     for br in line.find_all("br"):
         br.replace_with("\n")
-    line.smooth()
-    result = re.sub(r"\n\s+", r" ", "".join(line.strings))
-    return result
+    # get_text joins all the strings, so there's no need to smooth() first.
+    return _NL_WS_RE.sub(" ", line.get_text(""))
 
 
-def is_code_font(f: str):
+def google_link_target(href: str) -> str:
     """
-    Determines if the font name provided as `f` is considered to be a code font.
+    Extract the real destination from one of Google's redirect links.
+
+    If the link doesn't have a destination, it's returned unchanged.
     """
-    return f.strip().strip("'\"").lower() in {
-        "fira mono",
-        "roboto mono",
-        "source code pro",
-        "courier new",
-        "consolas",
-    }
+    match = _GOOGLE_URL_TARGET_RE.search(href)
+    return unquote_plus(match.group(1)) if match else href
 
 
-class HTMLCleaner:
-    def __init__(self):
-        css_parser_logger = getLogger("css_parser")
-        css_parser_logger.setLevel(getLogger().level + 10)
-        self.css_parser = CSSParser(log=css_parser_logger)
+def class_matcher(classes: Iterable[str]) -> Optional[re.Pattern]:
+    """
+    Compile a collection of class names into a single regex, suitable for
+    passing as `class_` to `find_all`.
+
+    bs4 tests a regex once against each class on a tag, whereas a list or set
+    is tested one entry at a time. Returns None if `classes` is empty.
+    """
+    classes = sorted(set(classes))
+    if not classes:
+        return None
+    return re.compile("^(?:" + "|".join(re.escape(c) for c in classes) + ")$")
 
+
+class HTMLCleaner:
     def remove_single_cell_tables(self, soup: BeautifulSoup):
         """
         Identify single cell tables, and replace them with their cell's contents.
         """
 
+        # Collect the tables before changing anything. Only whether there's more
+        # than one row or cell matters, so stop searching after the second.
         for table in soup.find_all("table"):
-            rows = table.find_all("tr")
+            rows = table.find_all("tr", limit=2)
             if len(rows) == 1:
-                cells = rows[0].find_all("td")
+                cells = rows[0].find_all("td", limit=2)
                 if len(cells) == 1:
                     cells[0].unwrap()
                     rows[0].unwrap()
                     table.unwrap()
 
-    def _extract_code_styles(self, soup: BeautifulSoup) -> List[str]:
+    def _extract_code_styles(self, soup: BeautifulSoup) -> Set[str]:
         """
         Identify the styles in the stylesheet that specify fixed-width fonts,
-        and create a list of these "code" classes.
+        and create a set of these "code" classes.
         """
 
         result = set()
         for st in soup.find_all("style"):
-            sheet = self.css_parser.parseString(st.string)
-            for rule in sheet.cssRules.rulesOfType(1):
-                # See if it contains a font-family rule:
-                for s in rule.style.getProperties(name="font-family"):
-                    if is_code_font(s.value):
-                        result.add(rule.selectorText.strip().strip("."))
+            code, _, _ = extract_style_classes(st.get_text())
+            result.update(code)
         debug(f"Code classes in HTML: {', '.join(result)}")
         return result
 
@@ -87,47 +128,61 @@ class HTMLCleaner:
         """
         result = {}
         for st in soup.find_all("style"):
-            sheet = self.css_parser.parseString(st.string)
-            for rule in sheet.cssRules.rulesOfType(1):
-                for s in rule.style.getProperties(name="font-weight"):
-                    if int(s.value) > 400:
-                        result.setdefault("b", []).append(
-                            rule.selectorText.strip().strip(".")
-                        )
-                for s in rule.style.getProperties(name="font-style"):
-                    if s.value == "italic":
-                        result.setdefault("i", []).append(
-                            rule.selectorText.strip().strip(".")
-                        )
+            _, bold, italic = extract_style_classes(st.get_text())
+            if bold:
+                result.setdefault("b", []).extend(bold)
+            if italic:
+                result.setdefault("i", []).extend(italic)
         debug(f"Span style classes: {', '.join(result)}")
         return result
 
+    def _style_span_classes(self, soup: BeautifulSoup) -> Tuple[Set[str], Set[str]]:
+        """
+        Return the sets of bold and italic classes defined in the stylesheet.
+        """
+        span_styles = self.extract_span_styles(soup)
+        return set(span_styles.get("b", [])), set(span_styles.get("i", []))
+
+    def _rename_style_span(
+        self, span: Tag, bold_classes: Set[str], italic_classes: Set[str]
+    ):
+        """
+        Rename `span` to <b> or <i> if it has a bold or italic class. Bold takes
+        precedence.
+        """
+        classes = span.get("class")
+        if classes:
+            if not bold_classes.isdisjoint(classes):
+                span.name = "b"
+            elif not italic_classes.isdisjoint(classes):
+                span.name = "i"
+
     def replace_style_spans(self, soup: BeautifulSoup):
         """
         Locate all spans that should be replaced with <b> or <i> tags,
         and make the fix.
         """
-        span_styles = self.extract_span_styles(soup)
-        for new_tag, span_styles in span_styles.items():
-            for span in soup.find_all("span", class_=span_styles):
-                span.name = new_tag
+        bold_classes, italic_classes = self._style_span_classes(soup)
+        if not (bold_classes or italic_classes):
+            return
+        for span in soup.find_all("span", class_=True):
+            self._rename_style_span(span, bold_classes, italic_classes)
 
-    def mark_code_blocks(self, soup: BeautifulSoup):
+    def _mark_code_spans(self, soup: BeautifulSoup, code_styles: Set[str]):
         """
-        Attempts to find consecutive lines of code and concatenate them into a single
-        code block contained within a <pre> tag.
+        Turn spans styled with a code font into <pre> blocks or <code> spans.
         """
-        # TODO: For this to work consistently, it needs to have a tag and modify approach.
-        # Step 1: Identify all code tokens
-        # Step 2: Consolidate consecutive code tokens
-        # Step 3: Identify and resolve code blocks (<pre>) vs code spans (<code>).
-        code_styles = self._extract_code_styles(soup)
-        for span in soup.find_all("span", class_=code_styles):
+        # Documents without any code fonts don't need the tree walking at all:
+        if not code_styles:
+            return
+
+        for span in soup.find_all("span", class_=class_matcher(code_styles)):
             p = span.parent
-            if p.name in {"p", "div", "td"}:
+            if p.name in _BLOCK_PARENTS:
                 if len(p.contents) == 1:  # Is it a line from a code BLOCK
                     prev = p.previous_sibling
-                    text = str(p.string if p.string else "")
+                    string = p.string
+                    text = str(string) if string else ""
                     if prev is None or prev.name != "pre":
                         # Hoist the '.string' content up to this level (remove 'span') and make it a 'pre'
                         p.name = "pre"
@@ -147,7 +202,17 @@ class HTMLCleaner:
                     else:
                         span.name = "code"
 
-        soup.smooth()
+    def mark_code_blocks(self, soup: BeautifulSoup):
+        """
+        Attempts to find consecutive lines of code and concatenate them into a single
+        code block contained within a <pre> tag.
+        """
+        # TODO: For this to work consistently, it needs to have a tag and modify approach.
+        # Step 1: Identify all code tokens
+        # Step 2: Consolidate consecutive code tokens
+        # Step 3: Identify and resolve code blocks (<pre>) vs code spans (<code>).
+        self._mark_code_spans(soup, self._extract_code_styles(soup))
+
         # Sometimes the formatting results in a paragraph containing a single <code> tag.
         # Let's see what we can do.
         for code in soup.find_all("code"):
@@ -159,7 +224,7 @@ class HTMLCleaner:
                             item.replace_with("\n")
 
             p = code.parent
-            if p.name in {"p", "div", "td"}:
+            if p.name in _BLOCK_PARENTS:
                 if len(p.contents) == 1:  # Is it a line from a code BLOCK
                     code.unwrap()
                     p.name = "pre"
@@ -169,32 +234,79 @@ class HTMLCleaner:
         # for pre in soup.find_all("pre"):
         #     pre.smooth()
 
+    def _fix_google_link(self, link: Tag):
+        """
+        Replace `link`'s href with its real destination, if it's a Google
+        redirect.
+        """
+        href = link.get("href")
+        if href and _GOOGLE_URL_RE.search(href):
+            link["href"] = google_link_target(href)
+
     def fix_google_links(self, soup: BeautifulSoup):
         """
         Google does this horrible link redirection thing. Fix it.
         """
-        for link in soup.find_all(
-            "a", attrs={"href": re.compile(r"https:\/\/www.google.com\/url")}
-        ):
-            link["href"] = parse_qs(urlparse(link["href"]).query)["q"][0]
+        for link in soup.find_all("a", href=True):
+            self._fix_google_link(link)
 
-    def remove_ids(self, soup: BeautifulSoup):
-        for tag in soup.find_all(id=True):
-            del tag["id"]
+    def _strip_attrs(self, tag: Tag):
+        """
+        Remove the id, class and style attributes from `tag`.
+        """
+        attrs = tag.attrs
+        attrs.pop("id", None)
+        attrs.pop("class", None)
+        attrs.pop("style", None)
 
-    def remove_classes(self, soup: BeautifulSoup):
-        for tag in soup.find_all(class_=True):
-            del tag["class"]
+    def strip_attrs(self, soup: BeautifulSoup):
+        """
+        Remove id, class and style attributes from every tag, in a single walk
+        of the tree.
+        """
+        for tag in soup.descendants:
+            # Most tags have no attributes at all, so skip them without any
+            # dict work:
+            if isinstance(tag, Tag) and tag.attrs:
+                self._strip_attrs(tag)
 
-    def remove_styles(self, soup: BeautifulSoup):
-        for tag in soup.find_all(style=True):
-            del tag["style"]
+    def rewrite_tags(self, soup: BeautifulSoup):
+        """
+        Does the work of replace_style_spans, fix_google_links, strip_attrs,
+        identify_code_blocks and remove_empty_paras in a single walk of the tree.
+        """
+        bold_classes, italic_classes = self._style_span_classes(soup)
+        has_span_styles = bool(bold_classes or italic_classes)
+
+        spans_and_paras = []
+        for tag in soup.descendants:
+            if not isinstance(tag, Tag):
+                continue
+            if tag.attrs:
+                if tag.name == "span" and has_span_styles:
+                    self._rename_style_span(tag, bold_classes, italic_classes)
+                elif tag.name == "a":
+                    self._fix_google_link(tag)
+                self._strip_attrs(tag)
+
+            if tag.name == "span" or tag.name == "p":
+                spans_and_paras.append(tag)
+            elif tag.name == "pre":
+                self._mark_python_block(tag)
+
+        # The tree is only restructured once the walk has finished:
+        self._remove_spans_and_empty_paras(spans_and_paras)
+
+    def _mark_python_block(self, pre: Tag):
+        """
+        Mark `pre` with the "python" class if it looks like Python code.
+        """
+        if _PYTHON_CODE_RE.search(pre.get_text()):
+            pre["class"] = ["python"]
 
     def identify_code_blocks(self, soup: BeautifulSoup):
         for pre in soup.find_all("pre"):
-            code = "".join(pre.contents)
-            if "import " in code or "def " in code:
-                pre["class"] = "python"
+            self._mark_python_block(pre)
 
     def process_building_block_code(self, soup: BeautifulSoup):
         """
@@ -217,7 +329,7 @@ class HTMLCleaner:
             for para in start_para.next_siblings:
                 # Ignore any whitespace between p tags.
                 if isinstance(para, Tag):
-                    end_span = para.find("span", string=re.compile("^\uEC02"))
+                    end_span = para.find("span", string=_BUILDING_BLOCK_END_RE)
                     if end_span is not None:
                         end_span.string = end_span.string[
                             1:
@@ -244,37 +356,52 @@ class HTMLCleaner:
         Replace backticks (`) in the content with <code> tags.
         """
 
-        soup.smooth()  # Relies on adjacent strings being concatenated.
-
-        # Loop through any tag with content that includes a backtick.
-        for tag in soup.find_all(True, string=re.compile(r"`")):
-            # Do a regex substitution to create the code tags.
-            # Then re-parse with bs4, and insert the new content into the existing tag.
-            # If there's a better way to re-create the tag soup from the substituted
-            # string, I'd love to know it.
-
-            # From the bs4 docs: If a tag’s only child is another tag, and that tag
-            # has a .string, then the parent tag is considered to have the same
-            # .string as its child.
-            # ☝🏻 This is quite annoying behaviour.
-            if not (len(tag.contents) == 1 and isinstance(tag.contents[0], Tag)):
-                content_body = BeautifulSoup(
-                    re.sub(r"`(.*?)`", r"<code>\1</code>", tag.string), "lxml"
-                ).html.body
-                if content_body.p is not None:
-                    tag_to_extract = content_body.p
-                else:
-                    tag_to_extract = content_body
-                new_contents = tag_to_extract.extract().contents
-                tag.clear()
-                tag.extend(new_contents)
+        # Find the tags directly containing a string with a backtick:
+        tags = {}
+        for string in soup.find_all(string=_BACKTICK_RE):
+            tags[id(string.parent)] = string.parent
+
+        for tag in tags.values():
+            # Only replace the content of tags consisting only of text. The text
+            # may be split over adjacent strings, so join them rather than
+            # relying on smooth(), which would walk every tag below this one.
+            contents = tag.contents
+            if not all(
+                isinstance(c, NavigableString) and not isinstance(c, PreformattedString)
+                for c in contents
+            ):
+                continue
+
+            new_contents = []
+            for i, part in enumerate(_BACKTICK_PAIR_RE.split("".join(contents))):
+                if i % 2:
+                    code = soup.new_tag("code")
+                    code.string = part
+                    new_contents.append(code)
+                elif part:
+                    new_contents.append(NavigableString(part))
+            tag.clear()
+            tag.extend(new_contents)
 
     def remove_empty_paras(self, soup: BeautifulSoup):
-        for tag in soup.find_all("span"):
-            tag.unwrap()
+        """
+        Unwrap all spans, and then remove any paragraphs left empty.
+        """
+        # Collect the tags in one walk, and mutate afterwards so the walk
+        # isn't disturbed:
+        spans_and_paras = soup.find_all(["span", "p"])
+        self._remove_spans_and_empty_paras(spans_and_paras)
 
-        for tag in soup.find_all(lambda tag: tag.name == "p" and not tag.contents):
-            tag.unwrap()
+    def _remove_spans_and_empty_paras(self, spans_and_paras: List[Tag]):
+        """
+        Unwrap the spans, and remove the empty paragraphs, in a list of spans and
+        paragraphs in document order.
+        """
+        # Working backwards handles each tag's descendants before the tag itself,
+        # so paragraphs that only contained empty spans are removed too.
+        for tag in reversed(spans_and_paras):
+            if tag.name == "span" or not tag.contents:
+                tag.unwrap()
 
 
 def default_log(msg):
@@ -293,40 +420,86 @@ def process_google_doc_html(soup: BeautifulSoup, log=default_log):
     cleaner.process_building_block_code(soup)
     log("Marking code blocks")
     cleaner.mark_code_blocks(soup)
-    log("Replacing style spans with <i> and <b>")
-    cleaner.replace_style_spans(soup)
-    log("Fixing Google's horrible indirect links")
-    cleaner.fix_google_links(soup)
-    log("Removing ids because they mess up the Markdown")
-    cleaner.remove_ids(soup)
-    log("Removing classes")
-    cleaner.remove_classes(soup)
-    log("Removing style attributes")
-    cleaner.remove_styles(soup)
-    log("Marking python code blocks as python")
-    cleaner.identify_code_blocks(soup)
     log("Replacing backticks with <code> tags")
     cleaner.fix_backticks(soup)
-    log("Removing empty paragraphs")
-    cleaner.remove_empty_paras(soup)
+    log("Cleaning up tags, links and attributes")
+    cleaner.rewrite_tags(soup)
+
+
+def convert_google_doc(input_path: Path, output_path: Path, log=default_log):
+    """
+    Convert an HTML file exported from Google Docs into a formatted Markdown file.
+    """
+    soup = parse_google_doc_html(Path(input_path).read_bytes())
+
+    log("Pre-processing HTML")
+    process_google_doc_html(soup, log=log)
+
+    log("Converting to Markdown")
+    do_pandoc_pypandoc(soup, Path(output_path), True)
+
+
+def _encode_node(node) -> bytes:
+    if isinstance(node, Tag):
+        return node.encode("utf-8")
+    return node.output_ready().encode("utf-8")
+
+
+def write_html(soup: BeautifulSoup, f: BinaryIO):
+    """
+    Serialize soup to the binary file `f` as UTF-8.
+
+    Nearly all of the document is inside <body>, so its children are encoded
+    one at a time, instead of building the whole document as a single string
+    first.
+    """
+    for child in soup.contents:
+        if isinstance(child, Tag) and child.name == "body":
+            # An empty copy of the tag provides its start and end tags:
+            end_tag = f"</{child.name}>".encode("utf-8")
+            start_tag = soup.new_tag(child.name, attrs=child.attrs).encode("utf-8")
+            f.write(start_tag[: -len(end_tag)])
+            for node in child.contents:
+                f.write(_encode_node(node))
+            f.write(end_tag)
+        else:
+            f.write(_encode_node(child))
+
+
+def format_markdown(markdown: str) -> str:
+    """
+    Tidy up pandoc's Markdown output with mdformat.
+    """
+    return mdformat.text(
+        markdown,
+        options={
+            "wrap": "no",
+        },
+        extensions={"gfm"},
+    )
 
 
 def do_pandoc_pypandoc(soup: BeautifulSoup, output_path: Path, format: bool):
+    """
+    Convert soup HTML into Markdown with pypandoc.
 
+    soup: The HTML source as a BeautifulSoup object.
+    output_path: A pathlib.Path specifying an output file.
+    format: Whether to run the output Markdown through mdformat after conversion.
+    """
     output = pypandoc.convert_text(
         str(soup),
-        "gfm-raw_html+pipe_tables",  # output format
-        format="html-native_divs-native_spans-raw_html",  # input format
+        PANDOC_OUTPUT_FORMAT,
+        format=PANDOC_INPUT_FORMAT,
+        # Unless it needs formatting, pandoc can write the Markdown itself,
+        # rather than sending it back through a pipe for us to write:
+        outputfile=None if format else str(output_path),
+        # Verifying the formats runs pandoc twice more, to list the formats it
+        # supports, for every conversion. These formats are fixed, so skip it:
+        verify_format=False,
     )
     if format:
-        output = mdformat.text(
-            output,
-            options={
-                "wrap": "no",
-            },
-            extensions={"gfm"},
-        )
-    output_path.write_text(output)
+        output_path.write_text(format_markdown(output), encoding="utf-8")
 
 
 def do_pandoc_subprocess(soup: BeautifulSoup, output_path: Path, format: bool):
@@ -337,28 +510,28 @@ def do_pandoc_subprocess(soup: BeautifulSoup, output_path: Path, format: bool):
     output_path: A pathlib.Path specifying an output file.
     format: Whether to run the output Markdown through mdformat after conversion.
     """
-    pandoc = Popen(
-        [
-            "pandoc",
-            "--to",
-            "gfm-raw_html+pipe_tables",
-            "-f",
-            "html-native_divs-native_spans-raw_html",
-            "-o",
-            str(output_path),
-        ],
-        stdin=PIPE,
-        text=True,
-    )
-
-    pandoc.communicate(input=str(soup))
+    args = [
+        "pandoc",
+        "--to",
+        PANDOC_OUTPUT_FORMAT,
+        "-f",
+        PANDOC_INPUT_FORMAT,
+    ]
+    if format:
+        # Read the Markdown straight back from pandoc, rather than writing it to
+        # output_path only for mdformat to read it again.
+        pandoc = Popen(args, stdin=PIPE, stdout=PIPE)
+    else:
+        pandoc = Popen(args + ["-o", str(output_path)], stdin=PIPE)
+
+    with pandoc.stdin:
+        write_html(soup, pandoc.stdin)
+    # pandoc reads all of its input before writing any output, so reading stdout
+    # after stdin has been closed can't deadlock.
+    output = pandoc.stdout.read() if format else None
     pandoc.wait()
 
     if format:
-        mdformat.file(
-            output_path,
-            options={
-                "wrap": "no",
-            },
-            extensions={"gfm"},
+        output_path.write_text(
+            format_markdown(output.decode("utf-8")), encoding="utf-8"
         )
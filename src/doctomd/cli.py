@@ -4,11 +4,15 @@ from logging import info
 from pathlib import Path
 import sys
 
-from bs4 import BeautifulSoup
 from rich.console import Console
 from rich.logging import RichHandler
 
-from . import process_google_doc_html, do_pandoc_pypandoc
+from . import (
+    parse_google_doc_html,
+    process_google_doc_html,
+    do_pandoc_pypandoc,
+    write_html,
+)
 
 def main(argv=sys.argv[1:]):
     console = Console(stderr=True, highlight=False)
@@ -64,14 +68,20 @@ def main(argv=sys.argv[1:]):
                 f"Can't write to path {output_path.parent} because it doesn't exist or isn't a directory."
             )
 
-        soup = BeautifulSoup(path.read_text(), "lxml")
+        soup = parse_google_doc_html(path.read_bytes())
 
         with console.status("Pre-processing HTML"):
             process_google_doc_html(soup, log=console.out)
 
         if args.no_pandoc:
             info("No pandoc")
-            output_path.write_text(str(soup))
+            with output_path.open("wb") as f:
+                # Only the stylesheet and body were parsed, so give them a
+                # document declaring the encoding write_html uses. The <body>
+                # start tag closes the <head>, after the stylesheet.
+                f.write(b'<!DOCTYPE html>\n<html><head><meta charset="utf-8">')
+                write_html(soup, f)
+                f.write(b"</html>\n")
         else:
             with console.status("Converting to Markdown"):
                 do_pandoc_pypandoc(soup, output_path, not args.no_format)
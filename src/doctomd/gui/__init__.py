@@ -3,6 +3,7 @@ import logging
 from logging import info, Handler, LogRecord
 from pathlib import Path
 import sys
+from typing import List
 
 from rich.console import Console
 from rich.logging import RichHandler
@@ -10,39 +11,45 @@ from rich.logging import RichHandler
 import toga
 from toga.style.pack import COLUMN, ROW
 
-from bs4 import BeautifulSoup
-
-from .. import process_google_doc_html, do_pandoc_pypandoc
+from .. import convert_google_doc
 
 
 class LogWidgetHandler(Handler):
+    """
+    Append log messages to a text widget.
+
+    Messages are batched, so a burst of records updates the widget once,
+    instead of re-rendering it for each record.
+    """
+
     def __init__(self, text_widget: toga.MultilineTextInput):
         super().__init__()
         self._multiline = text_widget
+        self._pending: List[str] = []
 
     def emit(self, record: LogRecord):
-        self._multiline.app.loop.call_soon(self.emit_in_loop, record)
-
-    def emit_in_loop(self, record: LogRecord):
-        self._multiline.value += record.getMessage() + "\n"
+        # Handler.handle holds self.lock while calling emit.
+        self._pending.append(record.getMessage())
+        if len(self._pending) == 1:
+            # Records can come from any thread, so schedule the flush safely:
+            try:
+                self._multiline.app.loop.call_soon_threadsafe(self.flush_in_loop)
+            except Exception:
+                # The widget isn't attached to a running app. Nothing will flush
+                # this batch, so drop it, or no later batch would be scheduled.
+                self._pending = []
+                self.handleError(record)
+
+    def flush_in_loop(self):
+        self.acquire()
+        try:
+            messages, self._pending = self._pending, []
+        finally:
+            self.release()
+        self._multiline.value += "".join(message + "\n" for message in messages)
         self._multiline.scroll_to_bottom()
 
 
-def do_conversion(input_path, output_path):
-    def converter():
-        soup = BeautifulSoup(Path(input_path).read_text(), "lxml")
-
-        info("Pre-processing HTML")
-        process_google_doc_html(soup)
-
-        info("Converting to Markdown")
-        do_pandoc_pypandoc(soup, Path(output_path), True)
-
-        info("Done.")
-
-    return converter
-
-
 class DocConverter(toga.App):
     input_file: str = None
 
@@ -78,9 +85,15 @@ class DocConverter(toga.App):
             )
             info(f"Output Path: {output_path}")
             if output_path is not None:
+                # Conversion runs on a thread, so it doesn't block the UI, and
+                # its log messages still reach the log widget:
                 await self.loop.run_in_executor(
-                    None, do_conversion(self.input_file_text_input.value, output_path)
+                    None,
+                    convert_google_doc,
+                    self.input_file_text_input.value,
+                    str(output_path),
                 )
+                info("Done.")
 
         convert_button.on_press = on_convert
 
@@ -148,7 +161,6 @@ def main(argv=sys.argv[1:]):
     )
     logging.getLogger("markdown_it").setLevel(logging.WARN)
     logging.getLogger("pypandoc").setLevel(logging.WARN)
-    logging.getLogger("css_parser").setLevel(logging.WARN)
 
     try:
         ap = ArgumentParser(prog="doc2md", description=__doc__)
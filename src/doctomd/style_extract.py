@@ -0,0 +1,124 @@
+"""
+Extract code, bold and italic classes from the stylesheets in Google Docs HTML.
+
+Google Docs generates flat, minified CSS, with no nesting and one class per
+styled rule, so the few properties doctomd cares about can be found with regular
+expressions instead of a full CSS parser.
+"""
+
+from functools import lru_cache
+import re
+from typing import Dict, FrozenSet, Iterator, Tuple
+
+_COMMENT_RE = re.compile(r"/\*.*?\*/", re.S)
+_BRACE_RE = re.compile(r"[{}]")
+# Matches a lone class selector, skipping any at-rules (like @import) before it:
+_CLASS_SELECTOR_RE = re.compile(r"(?:.*;)?\s*\.([\w-]+)\s*", re.S)
+_IMPORTANT_RE = re.compile(r"\s*!\s*important\s*$", re.I)
+_FONT_PROPERTY_RE = re.compile(r"font-", re.I)
+
+
+CODE_FONTS = frozenset(
+    {
+        "fira mono",
+        "roboto mono",
+        "source code pro",
+        "courier new",
+        "consolas",
+    }
+)
+
+
+@lru_cache(maxsize=256)
+def is_code_font(f: str):
+    """
+    Determines if the font name provided as `f` is considered to be a code font.
+
+    Stylesheets repeat the same few font-family values over and over, so the
+    results are cached.
+    """
+    return f.strip().strip("'\"").lower() in CODE_FONTS
+
+
+def is_bold_weight(weight: str):
+    """
+    Determines if the font-weight value provided as `weight` is heavier than normal.
+    """
+    weight = weight.strip().lower()
+    if weight.isdigit():
+        return int(weight) > 400
+    return weight in {"bold", "bolder"}
+
+
+def parse_declarations(block: str) -> Dict[str, str]:
+    """
+    Parse the declarations between a rule's braces into a dict of property names
+    to values. Later declarations override earlier ones.
+    """
+    result = {}
+    for declaration in block.split(";"):
+        name, sep, value = declaration.partition(":")
+        if sep:
+            result[name.strip().lower()] = _IMPORTANT_RE.sub("", value).strip()
+    return result
+
+
+def top_level_rules(css: str) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the selector and declaration block of each top-level rule in `css`.
+
+    At-rule blocks, like @media, are yielded whole, with their nested rules still
+    in the block, so the nested rules are never mistaken for top-level ones.
+    """
+    depth = 0
+    start = 0
+    for brace in _BRACE_RE.finditer(css):
+        if brace.group() == "{":
+            if depth == 0:
+                selector = css[start : brace.start()]
+                block_start = brace.end()
+            depth += 1
+        elif depth > 0:
+            depth -= 1
+            if depth == 0:
+                yield selector, css[block_start : brace.start()]
+                start = brace.end()
+
+
+@lru_cache(maxsize=32)
+def extract_style_classes(
+    css: str,
+) -> Tuple[FrozenSet[str], Tuple[str, ...], Tuple[str, ...]]:
+    """
+    Find the classes in the stylesheet `css` that are styled as code, bold or
+    italic, and return them as a tuple, in that order.
+
+    Only top-level rules with a single class selector (like `.c1`) are
+    considered, because they're the only ones that can be matched against a
+    span's classes, whatever the document is displayed on.
+
+    Results are cached, because each stylesheet is needed by more than one pass,
+    and converting the same document again produces the same stylesheet.
+    """
+    code, bold, italic = set(), [], []
+    # Scan the whole stylesheet once, so rules don't need checking one at a time
+    # if no code fonts are mentioned at all:
+    lowered = css.lower()
+    has_code_fonts = any(font in lowered for font in CODE_FONTS)
+    for selector, block in top_level_rules(_COMMENT_RE.sub("", css)):
+        # Most rules only set borders, padding and the like. Skip those before
+        # matching the selector or parsing any declarations:
+        if not _FONT_PROPERTY_RE.search(block):
+            continue
+        match = _CLASS_SELECTOR_RE.fullmatch(selector)
+        if match is None:
+            continue
+        class_name = match.group(1)
+        properties = parse_declarations(block)
+        if has_code_fonts and is_code_font(properties.get("font-family", "")):
+            code.add(class_name)
+        if is_bold_weight(properties.get("font-weight", "")):
+            bold.append(class_name)
+        if properties.get("font-style", "").lower() == "italic":
+            italic.append(class_name)
+    return frozenset(code), tuple(bold), tuple(italic)